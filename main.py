@@ -5,15 +5,25 @@ Main entry point for OpenCode Telegram Controller
 
 import sys
 import os
+import hmac
 import time
 import signal
 import subprocess
 import requests
-from src.telegram_controller import bot, logger, TELEGRAM_BOT_TOKEN, send_startup_message, active_process
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import telebot
+from src.telegram_controller import bot, logger, TELEGRAM_BOT_TOKEN, send_startup_message, active_process, command_executor, stop_opencode_server
 
 POLLING_TIMEOUT = 30
 POLLING_RETRY_DELAY = 5
 
+# Webhook mode: Telegram pushes updates instead of the bot long-polling.
+# Leave TELEGRAM_WEBHOOK_URL unset to fall back to polling (e.g. in development).
+WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL")  # Public HTTPS URL Telegram posts to
+WEBHOOK_LISTEN = os.environ.get("TELEGRAM_WEBHOOK_LISTEN", "127.0.0.1")  # Behind a reverse proxy
+WEBHOOK_PORT = int(os.environ.get("TELEGRAM_WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET")  # Required in webhook mode
+
 def cleanup_processes():
     """Clean up all active subprocesses before shutdown."""
     logger.info("Cleaning up active processes...")
@@ -31,12 +41,48 @@ def cleanup_processes():
             finally:
                 del active_process[chat_id]
     
+    command_executor.shutdown(wait=False, cancel_futures=True)
+    stop_opencode_server()
+    
     try:
         bot.stop_polling()
         logger.info("Stopped Telegram polling")
     except Exception as e:
         logger.error(f"Error stopping polling: {e}")
 
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Feed updates posted by Telegram to the bot."""
+    
+    def do_POST(self):
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            self.send_response(403)
+            self.end_headers()
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        # Acknowledge first so Telegram doesn't wait on (or retry) slow handlers
+        self.send_response(200)
+        self.end_headers()
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(body)])
+        except Exception as e:
+            logger.error(f"Error processing webhook update: {e}")
+    
+    def log_message(self, format, *args):
+        logger.debug("Webhook: " + format, *args)
+
+def run_webhook():
+    """Register the webhook with Telegram and serve updates until shutdown."""
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    logger.info(f"Listening for webhook updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
 def signal_handler(sig, frame):
     """Handle shutdown signals gracefully."""
     logger.info(f"Received signal {sig}, initiating shutdown...")
@@ -53,6 +99,20 @@ def main():
         sys.exit(1)
     send_startup_message()
     
+    if WEBHOOK_URL:
+        # Anyone who can reach the listener could otherwise post fake updates
+        if not WEBHOOK_SECRET:
+            logger.error("TELEGRAM_WEBHOOK_SECRET must be set to use webhook mode")
+            sys.exit(1)
+        run_webhook()
+        return
+    
+    # getUpdates is rejected while a webhook is registered
+    try:
+        bot.remove_webhook()
+    except Exception as e:
+        logger.warning(f"Failed to remove webhook: {e}")
+    
     retry_count = 0
     while True:
         try:
@@ -7,13 +7,27 @@ This bot controls opencode via CLI commands through Telegram.
 import os
 import re
 import json
+import codecs
+import functools
+import socket
 import subprocess
 import sys
-from typing import List, Dict, Any, Optional
+import time
+import threading
+import queue
+from collections import OrderedDict, deque
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple
 import logging
 from logging.handlers import RotatingFileHandler
 import pathlib
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Round-robin log rotation config
 LOG_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_ROTATION_DIR = os.path.join(LOG_DIR, "logs")
@@ -65,9 +79,49 @@ def setup_logging():
 
 logger = setup_logging()
 
+# JSON helpers: opencode emits one JSON object per output line, so decoding
+# is on the streaming hot path. Use orjson when it is installed.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers only
+# need to catch the latter.
+_JSON_EXTRA_DATA_MESSAGES = ("Extra data", "unexpected content after document")
+
+def parse_json(data):
+    """Decode a JSON document from str or bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def format_json(obj) -> str:
+    """Pretty-print an object as JSON with a two-space indent."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+        except TypeError:
+            pass  # e.g. non-str keys, which stdlib json coerces
+    return json.dumps(obj, indent=2)
+
+def format_json_compact(obj) -> str:
+    """Serialize an object as JSON without indentation or extra spaces."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
 # Environment variables
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
+# URL of a running `opencode serve`; `run` attaches to it instead of booting opencode per message
+OPENCODE_SERVER_URL = os.environ.get("OPENCODE_SERVER_URL")
+# Port for an `opencode serve` the bot starts (and restarts) itself when OPENCODE_SERVER_URL is unset
+OPENCODE_SERVE_PORT = os.environ.get("OPENCODE_SERVE_PORT")
+if OPENCODE_SERVE_PORT and not (OPENCODE_SERVE_PORT.isdigit() and 0 < int(OPENCODE_SERVE_PORT) < 65536):
+    logger.error(f"Invalid OPENCODE_SERVE_PORT {OPENCODE_SERVE_PORT!r}, not starting an opencode server")
+    OPENCODE_SERVE_PORT = None
+
+# Absolute path lets subprocess use posix_spawn instead of fork+exec
+OPENCODE_BIN = shutil.which("opencode") or "opencode"
 
 # Bot setup
 if not TELEGRAM_BOT_TOKEN:
@@ -81,17 +135,53 @@ except ImportError as e:
     logger.error(f"Failed to import telebot: {e}")
     sys.exit(1)
 
+# Share one pooled keep-alive session across the polling and worker threads;
+# telebot otherwise opens a session, and a TLS connection, per thread.
+TELEGRAM_POOL_SIZE = 16
+TELEGRAM_CONNECT_TIMEOUT = 10
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    api_session = requests.Session()
+    api_session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=4, pool_maxsize=TELEGRAM_POOL_SIZE, max_retries=2)
+    )
+    telebot.apihelper.session = api_session
+    telebot.apihelper.CONNECT_TIMEOUT = TELEGRAM_CONNECT_TIMEOUT
+except ImportError as e:
+    logger.warning(f"Using telebot's default HTTP sessions: {e}")
+
+# Telegram MarkdownV2 reserved characters, plus backslash itself.
+# Compiled once: escaping runs for every outbound message.
+_MDV2_SPECIAL_CHARS = '_*[]()~`>#+-=|{}.!\\'
+_MDV2_ESCAPE_RE = re.compile(f'([{re.escape(_MDV2_SPECIAL_CHARS)}])')
+_MDV2_TRANS = str.maketrans({c: '\\' + c for c in _MDV2_SPECIAL_CHARS})
+
+# Short strings (tool names, statuses, fixed replies) repeat constantly, so
+# their escaped form is memoized; longer ones are escaped directly to keep
+# the caches small.
+ESCAPE_CACHE_MAX_LENGTH = 512
+ESCAPE_CACHE_SIZE = 2048
+
+def _escape_markdown_v2(text: str) -> str:
+    # Both are single passes, so an inserted backslash is never escaped
+    # again. str.translate is several times faster on ASCII text but falls
+    # off its fast path for wider strings (emoji, Korean), where the
+    # regex wins.
+    if text.isascii():
+        return text.translate(_MDV2_TRANS)
+    return _MDV2_ESCAPE_RE.sub(r'\\\1', text)
+
+_escape_markdown_v2_cached = functools.lru_cache(maxsize=ESCAPE_CACHE_SIZE)(_escape_markdown_v2)
+
 # Telegram MarkdownV2 escape function
 def escape_markdown_v2(text: str) -> str:
     """Telegram MarkdownV2 escape function."""
-    # Escape special characters for Telegram MarkdownV2 (in order: \ first!)
-    result = text
-    # Must escape \ first to avoid double-escaping
-    result = result.replace('\\', '\\\\')
-    # Then escape other special chars
-    for char in r'_*$()~`>#+-=|{}.!':
-        result = result.replace(char, f'\\{char}')
-    return result
+    if len(text) > ESCAPE_CACHE_MAX_LENGTH:
+        return _escape_markdown_v2(text)
+    return _escape_markdown_v2_cached(text)
 
 # Send startup message if TELEGRAM_CHAT_ID is set
 def send_startup_message():
@@ -137,51 +227,114 @@ except Exception as e:
     logger.error(f"Failed to set bot commands: {e}")
 
 # In-memory storage (per chat)
-session_store: Dict[str, Dict[str, Any]] = {}
-project_store: Dict[str, str] = {}
-model_store: Dict[str, str] = {}
-active_process: Dict[str, Any] = {}  # Track active processes for cancel
+session_store: OrderedDict[int, Optional[str]] = OrderedDict()  # chat_id -> current session id, least recent first
+project_store: Dict[int, str] = {}
+model_store: Dict[int, str] = {}
+active_process: Dict[int, Any] = {}  # Track active processes for cancel
+store_lock = threading.Lock()  # Guards session_store across worker threads
+chat_queues: Dict[int, deque] = {}  # Prompts waiting per chat; present while one is running
+last_typing_action: Dict[int, float] = {}  # Last "typing" action sent per chat
 
 # Configuration constants
 COMMAND_TIMEOUT = 300  # 5 minutes timeout for commands
 MAX_MESSAGE_LENGTH = 4096  # Telegram message limit
 MAX_PREVIEW_LENGTH = 2500  # Max characters for response preview
+TEXT_PREVIEW_LENGTH = 300  # Streamed text beyond this is sent as a spoiler
+DETAIL_CHUNK_SIZE = 3500  # Full details are split to stay under MAX_MESSAGE_LENGTH
+TYPING_ACTION_INTERVAL = 4.0  # Telegram shows "typing" for ~5 s per action
+MAX_CONCURRENT_COMMANDS = 8  # opencode runs streamed in parallel across chats
+MAX_TRACKED_CHATS = 10000  # Least recently used chats beyond this forget their session
+TELEGRAM_SEND_RATE = 30.0  # Bot-wide messages per second Telegram accepts
+STREAM_BUFFER_SIZE = 64 * 1024  # Pipe read buffer for streamed opencode output
+STREAM_RESYNC_CHARS = 1024 * 1024  # Undecodable buffered output is skipped past this size
+BATCH_MAX_CHARS = 3500  # Flush batched stream messages before this size
+BATCH_FLUSH_INTERVAL = 0.5  # Max seconds a streamed message waits in the batch
+BATCH_IDLE_TIMEOUT = 0.2  # Flush the batch when output pauses this long
+SESSION_CACHE_TTL = 5.0  # Seconds to reuse `opencode session list` results
+MODELS_CACHE_TTL = 300.0  # Seconds to reuse `opencode models` results
+PRETTY_JSON_MAX_LENGTH = 256  # Larger tool inputs are shown as compact JSON
+PRETTY_JSON_CACHE_SIZE = 512  # Indented tool inputs kept for reuse
+
+# opencode message types process_output_line drops
+FILTERED_MESSAGE_TYPES = frozenset({"step_start", "step_finish", "session_update"})
+_STEP_MESSAGE_PREFIXES = ('{"type":"step_', '{"type": "step_')
+# step_start carries nothing the stream uses; such lines are skipped unparsed
+_STEP_START_PREFIXES = ('{"type":"step_start"', '{"type": "step_start"')
+
+# Shape of opencode session IDs (e.g. ses_...)
+_SESSION_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,128}\Z")
+
+# Last `opencode session list` as (timestamp, sessions, session_ids,
+# latest_session_id). The tuple is swapped whole, so readers on other
+# threads never see it half set.
+_session_list_cache: Optional[tuple] = None
+
+# Results of read-only opencode commands: args tuple -> (timestamp, result)
+_command_cache: Dict[tuple, tuple] = {}
+
+OPENCODE_SERVE_STARTUP_TIMEOUT = 15.0  # Seconds to wait for a started `opencode serve` to listen
+OPENCODE_SERVE_RETRY_MIN = 5.0  # Seconds before retrying a failed `opencode serve` start
+OPENCODE_SERVE_RETRY_MAX = 300.0  # Retry delay doubles per failure up to this
+_opencode_server: Optional[subprocess.Popen] = None
+_opencode_server_lock = threading.Lock()
+_opencode_server_retry_delay = 0.0
+_opencode_server_retry_at = 0.0  # Monotonic time before which runs stay standalone
+_opencode_server_starting: Optional[threading.Event] = None  # Set once an in-progress start is decided
+
+_send_rate_lock = threading.Lock()
+_next_send_slot = 0.0  # Earliest monotonic time the next streamed send may go out
+
+def _send_chat_action(chat_id: int, action: str) -> None:
+    try:
+        bot.send_chat_action(chat_id, action)
+    except Exception as e:
+        logger.warning(f"Failed to send chat action: {e}")
+
+def send_typing(chat_id: int) -> None:
+    """Show the typing indicator, skipping the API call while one is still shown.
+    
+    The call is made on a background thread so the caller never waits for it.
+    """
+    now = time.monotonic()
+    if now - last_typing_action.get(chat_id, 0.0) > TYPING_ACTION_INTERVAL:
+        last_typing_action[chat_id] = now
+        threading.Thread(target=_send_chat_action, args=(chat_id, 'typing'), daemon=True).start()
 
 def escape_only_dots(text: str) -> str:
-    """Escape Telegram MDV2 special characters, preserve ... ellipsis."""
-    result = escape_markdown_v2(text)
-    result = result.replace("\.\.\.", "...")
-    return result
+    """Fully escape text for Telegram MarkdownV2, same as escape_markdown_v2.
+    
+    Telegram rejects a bare "." in MarkdownV2, so an ellipsis is escaped
+    too; "\\.\\.\\." still renders as "...".
+    """
+    return escape_markdown_v2(text)
 
 def collect_output_for_summary():
     """Initialize output collection."""
     return {"lines": [], "summary": None, "full_text": ""}
 
-def process_line_for_summary(collect_data: dict, line: str, chat_id: Optional[str] = None) -> None:
-    """Process a line and add to collection, extract session ID if found."""
-    try:
-        if not line:
-            return
-        obj = json.loads(line)
-        
-        if "lines" not in collect_data:
-            collect_data["lines"] = []
-        collect_data["lines"].append(obj)
-        
-        msg_type = obj.get("type", "")
-        
-        if chat_id:
-            session_id = obj.get("sessionID") or obj.get("session_id")
-            if not session_id and "part" in obj:
-                part = obj.get("part", {})
-                session_id = part.get("sessionID") or part.get("session_id")
-            
-            if session_id and session_id != collect_data.get("last_session_id"):
-                collect_data["last_session_id"] = session_id
-                set_current_session_id(chat_id, session_id)
-                logger.info(f"Extracted session_id: {session_id}")
-    except json.JSONDecodeError:
-        pass
+def process_object_for_summary(collect_data: dict, obj: dict, chat_id: Optional[int] = None) -> None:
+    """Add a parsed output object to collection, extract session ID if found."""
+    if "lines" not in collect_data:
+        collect_data["lines"] = []
+    if obj.get("type") == "tool_use":
+        # Tool output (file contents, command output) is never shown; don't
+        # keep it alive for the rest of the run
+        part = obj.get("part")
+        state = part.get("state") if isinstance(part, dict) else None
+        if isinstance(state, dict):
+            state.pop("output", None)
+    collect_data["lines"].append(obj)
+    
+    if chat_id:
+        session_id = obj.get("sessionID") or obj.get("session_id")
+        if not session_id and isinstance(obj.get("part"), dict):
+            part = obj["part"]
+            session_id = part.get("sessionID") or part.get("session_id")
+        
+        if session_id and session_id != collect_data.get("last_session_id"):
+            collect_data["last_session_id"] = session_id
+            set_current_session_id(chat_id, session_id)
+            logger.info(f"Extracted session_id: {session_id}")
 
 def summarize_output(lines: List[dict]) -> dict:
     """Summarize output into key metrics."""
@@ -202,7 +355,10 @@ def summarize_output(lines: List[dict]) -> dict:
         elif msg_type == "directory":
             pass  # Ignore directories in summary
         elif msg_type == "tool_use":
-            tool_info = obj.get("part", {}).get("tool", "")
+            part = obj.get("part")
+            tool_info = part.get("tool") if isinstance(part, dict) else None
+            if not isinstance(tool_info, str):
+                tool_info = ""
             if "read" in tool_info:
                 summary["files_read"] += 1
             elif "write" in tool_info:
@@ -216,8 +372,10 @@ def summarize_output(lines: List[dict]) -> dict:
             elif "grep" in tool_info:
                 pass  # Text search
         elif msg_type == "text":
-            text = obj.get("text", "") or obj.get("part", {}).get("text", "")
-            if text.strip():
+            text = obj.get("text", "")
+            if not text and isinstance(obj.get("part"), dict):
+                text = obj["part"].get("text", "")
+            if isinstance(text, str) and text.strip():
                 summary["final_text"] += text + "\n"
         elif msg_type == "error":
             summary["errors"] += 1
@@ -264,87 +422,122 @@ def format_summary_message(summary: dict, detail_text: str = "") -> tuple:
     
     return "".join(message_lines), detail_text
 
-def process_output_line(line: str, chat_id: str) -> str:
-    """Process a single line of opencode output and format it for Telegram."""
+def format_text_line(obj: dict) -> str:
+    """Format a `text` output line."""
+    text_content = obj.get("text", "")
+    part = obj.get("part")
+    if isinstance(part, dict):
+        text_content = part.get("text", text_content)
+    # "text" may be null or not a string at all
+    return text_content.strip() if isinstance(text_content, str) else ""
+
+def _pretty_json(compact: str) -> str:
+    return format_json(parse_json(compact))
+
+# Tool calls repeat (same file read, same command); keyed by the compact form
+_pretty_json_cached = functools.lru_cache(maxsize=PRETTY_JSON_CACHE_SIZE)(_pretty_json)
+
+def format_tool_use_line(obj: dict) -> str:
+    """Format a `tool_use` output line."""
+    tool_name = "Unknown tool"
+    inputs = {}
+    status = ""
+    
+    part = obj.get("part")
+    if part and isinstance(part, dict):
+        tool_name = part.get("tool", "Unknown tool")
+        state = part.get("state") or {}
+        if not isinstance(state, dict):
+            state = {}
+        status = state.get("status", "")
+        inputs = state.get("input", {})
+    else:
+        tool_name = obj.get("tool_name", obj.get("tool", "Unknown tool"))
+        inputs = obj.get("input", {})
+    
+    parts = [f"[{tool_name}]:"]
+    if status:
+        parts.append(f"  Status: {status}")
+    if inputs:
+        # Only small inputs are worth the indented form's extra bytes
+        compact = format_json_compact(inputs)
+        if len(compact) < PRETTY_JSON_MAX_LENGTH:
+            compact = _pretty_json_cached(compact)
+        parts.append(f"  Input: {compact}")
+    return "\n".join(parts)
+
+# process_output_line formatters by message type
+OUTPUT_LINE_FORMATTERS = {
+    "text": format_text_line,
+    "tool_use": format_tool_use_line,
+}
+
+def process_output_line(line: str, chat_id: int) -> str:
+    """Process a single line of opencode output and format it for Telegram.
+    
+    Streamed runs don't come through here; iter_json_objects decodes them.
+    """
+    if not line:
+        return ""
+    # Plain-text output can't be JSON; skip the parser and its exception
+    first = line[0]
+    if first not in "{[" and not first.isspace():
+        return line.strip()
+    # step_start/step_finish are filtered anyway; don't parse them
+    if line.startswith(_STEP_MESSAGE_PREFIXES):
+        return ""
     try:
-        if not line:
-            return ""
-        obj = json.loads(line)
-        
-        # Filter out step_start and step_finish messages completely
-        if obj.get("type") == "step_start" or obj.get("type") == "step_finish":
+        obj = parse_json(line)
+        # A top-level array or scalar isn't an opencode event
+        if not isinstance(obj, dict):
             return ""
         
         msg_type = obj.get("type")
         
-        if msg_type == "text":
-            text_content = obj.get("text", "")
-            part = obj.get("part", {})
-            if part:
-                text_content = part.get("text", text_content)
-            return text_content.strip() or ""
-            
-        elif msg_type == "tool_use":
-            tool_name = "Unknown tool"
-            inputs = {}
-            status = ""
-            
-            part = obj.get("part", {})
-            if part:
-                tool_name = part.get("tool", "Unknown tool")
-                state = part.get("state", {})
-                status = state.get("status", "")
-                inputs = state.get("input", {})
-            else:
-                tool_name = obj.get("tool_name", obj.get("tool", "Unknown tool"))
-                inputs = obj.get("input", {})
-            
-            result = f"[{tool_name}]:"
-            if status:
-                result += f"\n  Status: {status}"
-            if inputs:
-                result += f"\n  Input: {json.dumps(inputs, indent=2)}"
-            return result.strip()
+        # Filter out step and session bookkeeping messages completely
+        if msg_type in FILTERED_MESSAGE_TYPES:
+            return ""
         
-        else:
-            return f"[{msg_type}]: {json.dumps(obj, indent=2)}"
+        formatter = OUTPUT_LINE_FORMATTERS.get(msg_type)
+        if formatter is None:
+            return f"[{msg_type}]: {format_json_compact(obj)}"
+        return formatter(obj)
             
     except json.JSONDecodeError as e:
-        if "Extra data" in str(e):
+        if any(msg in str(e) for msg in _JSON_EXTRA_DATA_MESSAGES):
             logger.warning(f"Skipping extra data in JSON: {line[:50]}")
             return ""
         logger.debug(f"JSON parse error: {e}")
         return line.strip() or ""
 
+# format_message formatters by message type
+MESSAGE_FORMATTERS = {
+    "text": lambda obj: obj.get("text", ""),
+    "error": lambda obj: f"Error: {obj.get('message', '')}",
+    "command": lambda obj: f"Running: {obj.get('command', '')}",
+    "file": lambda obj: f"Created file: {obj.get('path', '')}",
+    "directory": lambda obj: f"Created directory: {obj.get('path', '')}",
+    "completed": lambda obj: "Operation completed successfully.",
+}
+
 def format_message(obj: dict) -> str:
     """Format a message object for Telegram."""
-    message_type = obj.get("type")
-    
-    if message_type == "text":
-        return obj.get("text", "")
-    elif message_type == "error":
-        return f"Error: {obj.get('message', '')}"
-    elif message_type == "command":
-        return f"Running: {obj.get('command', '')}"
-    elif message_type == "file":
-        return f"Created file: {obj.get('path', '')}"
-    elif message_type == "directory":
-        return f"Created directory: {obj.get('path', '')}"
-    elif message_type == "completed":
-        return "Operation completed successfully."
-    else:
+    formatter = MESSAGE_FORMATTERS.get(obj.get("type"))
+    if formatter is None:
         # JSON format for unknown types
-        return json.dumps(obj, indent=2)
+        return format_json(obj)
+    return formatter(obj)
 
 def run_opencode_command(args: List[str], timeout: int = COMMAND_TIMEOUT) -> subprocess.CompletedProcess:
     """Run an opencode command and return the result."""
     try:
         result = subprocess.run(
-            ["opencode"] + args,
+            [OPENCODE_BIN] + args,
             capture_output=True,
             text=True,
             check=True,
-            timeout=timeout
+            timeout=timeout,
+            close_fds=False
         )
         return result
     except subprocess.TimeoutExpired:
@@ -354,44 +547,194 @@ def run_opencode_command(args: List[str], timeout: int = COMMAND_TIMEOUT) -> sub
         logger.error(f"opencode command failed: {e}")
         raise
 
+def _wait_for_port(port: int, timeout: float, process: subprocess.Popen) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # Exited (e.g. the port is taken by something else): don't mistake
+        # another listener for it, and don't wait out the timeout
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def _terminate_process(process: subprocess.Popen) -> None:
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def _opencode_server_failed() -> None:
+    """Back off before the next start attempt. Call with _opencode_server_lock held."""
+    global _opencode_server_retry_delay, _opencode_server_retry_at
+    _opencode_server_retry_delay = min(max(_opencode_server_retry_delay * 2, OPENCODE_SERVE_RETRY_MIN), OPENCODE_SERVE_RETRY_MAX)
+    _opencode_server_retry_at = time.monotonic() + _opencode_server_retry_delay
+
+def _start_opencode_server() -> Optional[subprocess.Popen]:
+    """Spawn `opencode serve` and wait for it to listen; None if it didn't."""
+    try:
+        server = subprocess.Popen(
+            [OPENCODE_BIN, "serve", "--hostname", "127.0.0.1", "--port", OPENCODE_SERVE_PORT],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=False
+        )
+    except OSError as e:
+        logger.error(f"Failed to start opencode server: {e}")
+        return None
+    if not _wait_for_port(int(OPENCODE_SERVE_PORT), OPENCODE_SERVE_STARTUP_TIMEOUT, server):
+        logger.error(f"opencode server did not start listening (exit code {server.poll()}), running standalone")
+        _terminate_process(server)
+        return None
+    return server
+
+def get_opencode_server_url() -> Optional[str]:
+    """Return the URL `opencode run` should attach to, or None to run standalone.
+    
+    With OPENCODE_SERVE_PORT set, the bot keeps its own `opencode serve`
+    running and starts it again if it has exited. Starting can take up to
+    OPENCODE_SERVE_STARTUP_TIMEOUT, so call this from a worker thread. The
+    lock is not held meanwhile; concurrent callers wait for that start
+    instead. After a failed start, runs stay standalone until the retry
+    backoff has passed.
+    """
+    global _opencode_server, _opencode_server_retry_delay, _opencode_server_starting
+    if OPENCODE_SERVER_URL:
+        return OPENCODE_SERVER_URL
+    if not OPENCODE_SERVE_PORT:
+        return None
+    url = f"http://127.0.0.1:{OPENCODE_SERVE_PORT}"
+    with _opencode_server_lock:
+        if _opencode_server is not None and _opencode_server.poll() is None:
+            return url
+        if _opencode_server is not None:
+            logger.warning(f"opencode server exited with code {_opencode_server.returncode}, restarting")
+            _opencode_server = None
+        starting = _opencode_server_starting
+        if starting is None:
+            if time.monotonic() < _opencode_server_retry_at:
+                return None
+            _opencode_server_starting = threading.Event()
+    
+    if starting is not None:
+        # Another worker is starting it
+        starting.wait(OPENCODE_SERVE_STARTUP_TIMEOUT + 5)
+        with _opencode_server_lock:
+            running = _opencode_server is not None and _opencode_server.poll() is None
+        return url if running else None
+    
+    server = _start_opencode_server()
+    with _opencode_server_lock:
+        if server is None:
+            _opencode_server_failed()
+        else:
+            _opencode_server = server
+            _opencode_server_retry_delay = 0.0
+            logger.info(f"Started opencode server on port {OPENCODE_SERVE_PORT}")
+        starting, _opencode_server_starting = _opencode_server_starting, None
+    starting.set()
+    return url if server is not None else None
+
+def stop_opencode_server() -> None:
+    """Terminate the `opencode serve` started by the bot, if any."""
+    global _opencode_server
+    with _opencode_server_lock:
+        server, _opencode_server = _opencode_server, None
+    if server is not None:
+        _terminate_process(server)
+
+def run_cached_opencode_command(args: List[str], ttl: float, timeout: int = COMMAND_TIMEOUT) -> subprocess.CompletedProcess:
+    """Run a read-only opencode command, reusing a result younger than ttl seconds."""
+    key = tuple(args)
+    cached = _command_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    result = run_opencode_command(args, timeout=timeout)
+    _command_cache[key] = (time.monotonic(), result)
+    return result
+
 def format_session_list(sessions_data) -> str:
     """Format session list for Telegram."""
     if not sessions_data:
         return "No sessions available."
     
-    formatted = "Available Sessions:\n"
-    for session in sessions_data:
-        formatted += f"- {session['id']}\n"
-    return formatted
+    return "Available Sessions:\n" + "".join(f"- {session['id']}\n" for session in sessions_data)
+
+def _get_session_list(ttl: float) -> tuple:
+    """Return the whole (timestamp, sessions, session_ids, latest_session_id) cache entry."""
+    global _session_list_cache
+    cached = _session_list_cache
+    if cached is not None and time.monotonic() - cached[0] < ttl:
+        return cached
+    result = run_opencode_command(["session", "list", "--format", "json"])
+    sessions_data = parse_json(result.stdout)
+    latest_id = ""
+    if isinstance(sessions_data, list):
+        session_ids = frozenset(s.get("id") for s in sessions_data)
+        if sessions_data:
+            latest = max(sessions_data, key=lambda x: x.get('updated', x.get('created', 0)))
+            latest_id = latest.get('id', '')
+    else:
+        session_ids = frozenset()
+    cached = (time.monotonic(), sessions_data, session_ids, latest_id)
+    _session_list_cache = cached
+    return cached
+
+def get_cached_sessions(ttl: float = SESSION_CACHE_TTL) -> tuple:
+    """Return (sessions, session_ids) from `opencode session list`.
+    
+    A result younger than ttl seconds is reused instead of running the command.
+    """
+    cached = _get_session_list(ttl)
+    return cached[1], cached[2]
 
-def is_valid_session_id(session_id: str, chat_id: str) -> bool:
+def get_latest_session_id(ttl: float = SESSION_CACHE_TTL) -> str:
+    """Return the most recently updated session ID, or "" if there are none."""
+    # Read from the same entry; the global may be invalidated meanwhile
+    return _get_session_list(ttl)[3]
+
+def invalidate_session_cache() -> None:
+    """Force the next get_cached_sessions call to run `opencode session list`."""
+    global _session_list_cache
+    _session_list_cache = None
+
+def is_valid_session_id(session_id: str, chat_id: int) -> bool:
     """Check if a session ID is valid by comparing against session list."""
+    # Reject malformed IDs without listing sessions
+    if not _SESSION_ID_RE.match(session_id):
+        return False
     try:
-        result = run_opencode_command(["session", "list", "--format", "json"])
-        sessions_data = json.loads(result.stdout)
-        session_ids = [s["id"] for s in sessions_data]
+        _, session_ids = get_cached_sessions()
         return session_id in session_ids
     except Exception:
         return False  # If we can't validate, assume it might be valid
 
-def set_current_session_id(chat_id: str, session_id: str) -> None:
+def set_current_session_id(chat_id: int, session_id: str) -> None:
     """Set the current session ID for a chat."""
-    if chat_id not in session_store:
-        session_store[chat_id] = {}
-    session_store[chat_id]["current_session_id"] = session_id
+    with store_lock:
+        session_store[chat_id] = session_id
+        session_store.move_to_end(chat_id)
+        if len(session_store) > MAX_TRACKED_CHATS:
+            session_store.popitem(last=False)
 
-def get_current_session_id(chat_id: str) -> str:
+def get_current_session_id(chat_id: int) -> str:
     """Get the current session ID for a chat."""
-    if chat_id not in session_store:
-        return ""
-    session_id = session_store[chat_id].get("current_session_id")
+    with store_lock:
+        session_id = session_store.get(chat_id)
+        if session_id is not None:
+            session_store.move_to_end(chat_id)
     return session_id if session_id is not None else ""
 
-def set_current_project(chat_id: str, project_path: str) -> None:
+def set_current_project(chat_id: int, project_path: str) -> None:
     """Set the current project path for a chat."""
     project_store[chat_id] = project_path
 
-def get_current_project(chat_id: str) -> str:
+def get_current_project(chat_id: int) -> str:
     """Get the current project path for a chat."""
     return project_store.get(chat_id, "")
 
@@ -412,18 +755,18 @@ def get_project_path(project_name: str) -> str:
     """Get full path for a project by name."""
     return os.path.join(os.path.expanduser("~/projects"), project_name)
 
-def set_current_model(chat_id: str, model_name: str) -> None:
+def set_current_model(chat_id: int, model_name: str) -> None:
     """Set the current model for a chat."""
     model_store[chat_id] = model_name
 
-def get_current_model(chat_id: str) -> str:
+def get_current_model(chat_id: int) -> str:
     """Get the current model for a chat."""
     return model_store.get(chat_id, "")
 
 def get_available_models() -> List[str]:
     """Get list of available models from opencode."""
     try:
-        result = run_opencode_command(["models"], timeout=10)
+        result = run_cached_opencode_command(["models"], MODELS_CACHE_TTL, timeout=10)
         models = result.stdout.strip().split("\n")
         return [m.strip() for m in models if m.strip()]
     except Exception:
@@ -473,6 +816,8 @@ def get_action_message(tool: str, status: str, part: Optional[dict] = None) -> O
         input_data = part["inputs"]
     elif "state" in part and isinstance(part["state"], dict) and "input" in part["state"]:
         input_data = part["state"]["input"]
+    if not isinstance(input_data, dict):
+        input_data = {}
     
     # Try each parameter key in order
     value = None
@@ -504,7 +849,7 @@ def get_action_message(tool: str, status: str, part: Optional[dict] = None) -> O
                         return f"{matched_action}: {v}", v
         
         # Fall back to JSON if no simple value found
-        json_str = json.dumps(input_data, indent=2)
+        json_str = format_json(input_data)
         if len(json_str) > 150:
             preview = json_str[:100]
             hidden = json_str[100:]
@@ -514,8 +859,205 @@ def get_action_message(tool: str, status: str, part: Optional[dict] = None) -> O
     
     return f"{matched_action}", None
 
-def stream_opencode_output(chat_id: str, command_args: List[str]) -> None:
+_JSON_DECODER = json.JSONDecoder()
+
+def _decode_json_objects(text: str) -> Tuple[List[dict], Optional[int], bool]:
+    """Decode consecutive JSON objects in text.
+    
+    Returns (objects, rest, malformed): rest is the offset of an object that
+    is still incomplete at the end of text, or None if all of text was used.
+    """
+    try:
+        obj = parse_json(text)
+    except ValueError:
+        pass
+    else:
+        if isinstance(obj, dict):
+            return [obj], None, False
+    objects = []
+    pos = 0
+    end = len(text)
+    while True:
+        while pos < end and text[pos].isspace():
+            pos += 1
+        if pos == end:
+            return objects, None, False
+        if text[pos] != "{":
+            return objects, None, True
+        try:
+            obj, next_pos = _JSON_DECODER.raw_decode(text, pos)
+        except json.JSONDecodeError as e:
+            if e.pos >= end:
+                return objects, pos, False
+            return objects, None, True
+        objects.append(obj)
+        pos = next_pos
+
+def iter_json_objects(chunks: Iterable[str], skip_prefixes: Tuple[str, ...] = ()) -> Iterator[dict]:
+    """Yield each JSON object from a stream of text chunks as soon as it closes.
+    
+    Chunks may end anywhere, so text is only decoded once a newline (or the
+    end of the stream) arrives; a partial line is never dropped. An object
+    spanning several lines (large tool payloads are not always on one line)
+    is kept until it decodes, or skipped once it grows past
+    STREAM_RESYNC_CHARS. Non-JSON lines are logged and skipped, as are
+    malformed objects and lines starting with one of skip_prefixes.
+    """
+    partial: List[str] = []  # text after the last newline
+    object_lines: List[str] = []  # lines of an object that hasn't closed yet
+    object_len = 0
+    
+    def handle_line(line: str) -> Iterator[dict]:
+        nonlocal object_len
+        if object_lines:
+            object_lines.append(line)
+            object_len += len(line) + 1
+            # An object can only close on a line ending with "}"
+            if not line.rstrip().endswith("}"):
+                if object_len > STREAM_RESYNC_CHARS:
+                    logger.debug("Skipping unterminated output: %s", object_lines[0][:50])
+                    object_lines.clear()
+                    object_len = 0
+                return
+            text = "\n".join(object_lines)
+        else:
+            text = line.strip()
+            if not text:
+                return
+            # Plain-text lines never reach the decoder or its exception
+            if text[0] != "{":
+                logger.debug("%s", text)
+                return
+            if skip_prefixes and text.startswith(skip_prefixes):
+                return
+        objects, rest, malformed = _decode_json_objects(text)
+        for obj in objects:
+            logger.debug("%s", obj)
+            yield obj
+        if rest is not None and len(text) - rest <= STREAM_RESYNC_CHARS:
+            object_lines[:] = [text[rest:]]
+            object_len = len(text) - rest
+            return
+        retry = malformed and len(object_lines) > 1
+        if malformed or rest is not None:
+            logger.debug("Skipping undecodable output: %s", text[:50])
+        object_lines.clear()
+        object_len = 0
+        if retry:
+            # The earlier lines were a truncated object; this line may be a
+            # complete event of its own
+            yield from handle_line(line)
+    
+    for chunk in chunks:
+        if "\n" not in chunk:
+            partial.append(chunk)
+            continue
+        partial.append(chunk)
+        text = "".join(partial)
+        end = text.rfind("\n")
+        partial = [text[end + 1:]] if end + 1 < len(text) else []
+        for line in text[:end].split("\n"):
+            yield from handle_line(line)
+    if partial:
+        yield from handle_line("".join(partial))
+    if object_lines:
+        logger.debug("Unterminated output: %s", object_lines[0][:50])
+
+def read_text_chunks(stream, size: int = STREAM_BUFFER_SIZE) -> Iterator[str]:
+    """Yield UTF-8 text from a binary pipe in chunks of up to size bytes.
+    
+    read1 returns whatever one read() on the pipe delivers, so output is
+    passed on as soon as it arrives without a syscall and decode per line.
+    The incremental decoder keeps characters split across chunks intact.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        data = stream.read1(size)
+        if not data:
+            break
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+def drain_stderr(stream) -> None:
+    """Log subprocess stderr lines as they arrive."""
+    for line in stream:
+        logger.error("STDERR: %s", line.decode("utf-8", "replace").strip())
+
+def wait_for_send_slot() -> None:
+    """Block until the bot-wide send rate allows another message.
+    
+    Streams for several chats run in parallel; spacing their sends keeps
+    the bot under Telegram's global limit instead of collecting 429s.
+    """
+    global _next_send_slot
+    with _send_rate_lock:
+        now = time.monotonic()
+        slot = max(now, _next_send_slot)
+        _next_send_slot = slot + 1.0 / TELEGRAM_SEND_RATE
+    if slot > now:
+        time.sleep(slot - now)
+
+def send_outbox(chat_id: int, outbox: queue.Queue) -> None:
+    """Send (text, parse_mode) messages from outbox in order until a None arrives.
+    
+    Plain-text items (parse_mode None) are coalesced into one message: each
+    send is a full HTTPS round-trip. A batch is sent when it is full, when
+    it is BATCH_FLUSH_INTERVAL old, or when nothing new arrives for
+    BATCH_IDLE_TIMEOUT. Plain text renders exactly like fully escaped
+    MarkdownV2, without the escape pass or Telegram's entity parsing.
+    """
+    pending: List[str] = []
+    pending_len = 0
+    batch_started = 0.0
+    
+    def send(text: str, parse_mode: Optional[str]) -> None:
+        wait_for_send_slot()
+        try:
+            bot.send_message(chat_id, text, parse_mode=parse_mode)
+        except Exception as e:
+            logger.warning(f"Failed to send streamed output: {e}")
+    
+    def flush() -> None:
+        nonlocal pending_len
+        if pending:
+            send("\n\n".join(pending), None)
+            pending.clear()
+        pending_len = 0
+    
+    while True:
+        try:
+            item = outbox.get(timeout=BATCH_IDLE_TIMEOUT if pending else None)
+        except queue.Empty:
+            flush()
+            continue
+        if item is None:
+            flush()
+            return
+        text, parse_mode = item
+        if parse_mode is not None:
+            flush()
+            send(text, parse_mode)
+            continue
+        if pending and pending_len + len(text) > BATCH_MAX_CHARS:
+            flush()
+        if not pending:
+            batch_started = time.monotonic()
+        pending.append(text)
+        pending_len += len(text) + 2
+        if pending_len > BATCH_MAX_CHARS or time.monotonic() - batch_started > BATCH_FLUSH_INTERVAL:
+            flush()
+
+def stream_opencode_output(chat_id: int, command_args: List[str]) -> None:
     """Stream opencode command output to terminal, send only summary to Telegram."""
+    # Streamed updates are sent from a dedicated thread so a slow Telegram
+    # round-trip never stalls reading opencode's stdout.
+    outbox: queue.Queue = queue.Queue()
+    sender_thread = threading.Thread(target=send_outbox, args=(chat_id, outbox), daemon=True)
+    sender_thread.start()
     try:
         sent_messages = set()
         last_action = None
@@ -523,126 +1065,110 @@ def stream_opencode_output(chat_id: str, command_args: List[str]) -> None:
         logger.info(f"Executing opencode command with args: {command_args}")
         
         process = subprocess.Popen(
-            ["opencode"] + command_args,
+            [OPENCODE_BIN] + command_args,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1
+            bufsize=STREAM_BUFFER_SIZE,
+            close_fds=False
         )
         active_process[chat_id] = process
         
+        # Drain stderr alongside stdout: if it is only read after stdout
+        # ends, a chatty stderr fills the pipe and blocks opencode.
+        stderr_thread = None
+        if process.stderr:
+            stderr_thread = threading.Thread(target=drain_stderr, args=(process.stderr,), daemon=True)
+            stderr_thread.start()
+        
         collect_data = collect_output_for_summary()
         
+        def queue_message(msg: str):
+            outbox.put((msg, None))
+        
         # Stream stdout
         if process.stdout:
-            for line in process.stdout:
-                line = line.strip()
-                if not line:
-                    continue
+            for obj in iter_json_objects(read_text_chunks(process.stdout), _STEP_START_PREFIXES):
+                process_object_for_summary(collect_data, obj, chat_id)
                 
-                logger.debug("%s", line)
-                process_line_for_summary(collect_data, line, chat_id)
+                # Send minimal status updates
+                msg_type = obj.get("type", "")
                 
-                # Parse and send minimal status updates
-                try:
-                    obj = json.loads(line)
-                    msg_type = obj.get("type", "")
+                # Tool finished - send detailed action info
+                if msg_type == "tool_use":
+                    # Any of these may be null in a malformed event
+                    part = obj.get("part")
+                    if not isinstance(part, dict):
+                        part = {}
+                    tool = part.get("tool")
+                    if not isinstance(tool, str):
+                        tool = ""
+                    state = part.get("state")
+                    status = state.get("status", "") if isinstance(state, dict) else ""
                     
-                    # Tool finished - send detailed action info
-                    if msg_type == "tool_use":
-                        part = obj.get("part", {})
-                        tool = part.get("tool", "")
-                        state = part.get("state", {})
-                        status = state.get("status", "")
-                        
-                        logger.debug(f"Tool: {tool}, Status: {status}")
-                        
-                        result = get_action_message(tool, status, part)
-                        # Send tool action for completed/started/success
-                        if result and status in ("completed", "started", "success"):
-                            action_msg, full_detail = result
-                            
-                            bot.send_chat_action(chat_id, 'typing')
-                            escaped_msg = escape_markdown_v2(action_msg)
-                            
-                            try:
-                                bot.send_message(chat_id, escaped_msg, parse_mode="MarkdownV2")
-                                logger.info(f"✅ {tool}: {status}")
-                            except Exception as e:
-                                logger.error(f"Failed to send tool action: {e}")
+                    logger.debug(f"Tool: {tool}, Status: {status}")
                     
-                    # Text output - send to Telegram
-                    elif msg_type == "text":
-                        text_content = obj.get("text", "")
-                        part = obj.get("part", {})
-                        if part:
-                            text_content = part.get("text", text_content)
+                    result = get_action_message(tool, status, part)
+                    # Send tool action for completed/started/success
+                    if result and status in ("completed", "started", "success"):
+                        action_msg, full_detail = result
                         
-                        if text_content.strip():
-                            text = text_content.strip()
-                            if len(text) > 300:
-                                preview = text[:300]
-                                hidden = text[300:]
-                                display_text = f"{preview}\n||{hidden}||"
-                            else:
-                                display_text = text
-                            bot.send_chat_action(chat_id, 'typing')
-                            try:
-                                bot.send_message(chat_id, escape_markdown_v2(display_text), parse_mode="MarkdownV2")
-                                logger.info(f"📝 Text output sent ({len(text_content)} chars)")
-                            except Exception as e:
-                                logger.warning(f"Failed to send text output: {e}")
-                    
-                    # Session started - show session ID
-                    elif msg_type == "session_started":
-                        session_id = obj.get("session_id", "")
-                        if session_id:
-                            msg = f"📝 Session: {session_id[:12]}..."
-                            if msg not in sent_messages:
-                                sent_messages.add(msg)
-                                bot.send_chat_action(chat_id, 'typing')
-                                try:
-                                    bot.send_message(chat_id, escape_markdown_v2(msg), parse_mode="MarkdownV2")
-                                    logger.info(f"🚀 Session started: {session_id}")
-                                except Exception as e:
-                                    logger.warning(f"Failed to send session start: {e}")
-                    
-                    # Step finished with summary - indicate completion
-                    elif msg_type == "step_finish":
-                        step = obj.get("step", -1)
-                        if step > 0:
-                            msg = f"✅ Step {step} completed"
-                            if msg not in sent_messages:
-                                sent_messages.add(msg)
-                                try:
-                                    bot.send_chat_action(chat_id, 'typing')
-                                    bot.send_message(chat_id, escape_markdown_v2(msg), parse_mode="MarkdownV2")
-                                except Exception:
-                                    pass
-                    
-                    # Error - notify immediately
-                    elif msg_type == "error":
-                        error_msg = obj.get("text", "") or obj.get("message", "")
-                        if error_msg:
-                            error_preview = error_msg[:100] + "..." if len(error_msg) > 100 else error_msg
-                            msg = f"⚠️ Error: {error_preview}"
-                            if msg not in sent_messages:
-                                sent_messages.add(msg)
-                                try:
-                                    bot.send_chat_action(chat_id, 'typing')
-                                    bot.send_message(chat_id, escape_markdown_v2(msg), parse_mode="MarkdownV2")
-                                except Exception as e:
-                                    logger.warning(f"Failed to send error: {e}")
-                    
-                except json.JSONDecodeError:
-                    pass
+                        send_typing(chat_id)
+                        queue_message(action_msg)
+                        logger.info(f"✅ {tool}: {status}")
+                
+                # Text output - send to Telegram
+                elif msg_type == "text":
+                    text = format_text_line(obj)
+                    if text:
+                        if len(text) > TEXT_PREVIEW_LENGTH:
+                            preview = text[:TEXT_PREVIEW_LENGTH]
+                            hidden = text[TEXT_PREVIEW_LENGTH:]
+                            display_text = f"{preview}\n||{hidden}||"
+                        else:
+                            display_text = text
+                        send_typing(chat_id)
+                        queue_message(display_text)
+                        logger.info(f"📝 Text output queued ({len(text)} chars)")
+                
+                # Session started - show session ID
+                elif msg_type == "session_started":
+                    session_id = obj.get("session_id", "")
+                    if session_id:
+                        msg = f"📝 Session: {session_id[:12]}..."
+                        if msg not in sent_messages:
+                            sent_messages.add(msg)
+                            send_typing(chat_id)
+                            queue_message(msg)
+                            logger.info(f"🚀 Session started: {session_id}")
+                
+                # Step finished with summary - indicate completion
+                elif msg_type == "step_finish":
+                    step = obj.get("step", -1)
+                    if step > 0:
+                        msg = f"✅ Step {step} completed"
+                        if msg not in sent_messages:
+                            sent_messages.add(msg)
+                            send_typing(chat_id)
+                            queue_message(msg)
+                
+                # Error - notify immediately
+                elif msg_type == "error":
+                    error_msg = obj.get("text", "") or obj.get("message", "")
+                    if error_msg:
+                        error_preview = error_msg[:100] + "..." if len(error_msg) > 100 else error_msg
+                        msg = f"⚠️ Error: {error_preview}"
+                        if msg not in sent_messages:
+                            sent_messages.add(msg)
+                            send_typing(chat_id)
+                            outbox.put((escape_markdown_v2(msg), "MarkdownV2"))
+                
         
-        # Stream stderr
-        if process.stderr:
-            for line in process.stderr:
-                logger.error("STDERR: %s", line.strip())
+        outbox.put(None)
+        sender_thread.join()
         
         return_code = process.wait()
+        if stderr_thread:
+            stderr_thread.join()
         if return_code != 0:
             logger.error(f"opencode command exited with code {return_code}")
         
@@ -660,7 +1186,7 @@ def stream_opencode_output(chat_id: str, command_args: List[str]) -> None:
         
         try:
             # Send typing before summary
-            bot.send_chat_action(chat_id, 'typing')
+            send_typing(chat_id)
             bot.send_message(
                 chat_id,
                 f"📊 Summary:\n\n{escaped_summary}",
@@ -671,8 +1197,7 @@ def stream_opencode_output(chat_id: str, command_args: List[str]) -> None:
             if detail_text and len(detail_text) > 1000:
                 logger.info(f"Sending full details ({len(detail_text)} chars)")
                 
-                # Telegram message limit is 4096 characters
-                chunk_size = 3500
+                chunk_size = DETAIL_CHUNK_SIZE
                 chunks = [detail_text[i:i+chunk_size] for i in range(0, len(detail_text), chunk_size)]
                 
                 for idx, chunk in enumerate(chunks, 1):
@@ -682,7 +1207,7 @@ def stream_opencode_output(chat_id: str, command_args: List[str]) -> None:
                         chunk_msg = f"📋 Full Details (cont.) #{idx}:\n\n{escape_markdown_v2(chunk)}"
                     
                     # Send typing before each detail chunk
-                    bot.send_chat_action(chat_id, 'typing')
+                    send_typing(chat_id)
                     bot.send_message(chat_id, chunk_msg, parse_mode="MarkdownV2")
                     logger.info(f"Sent detail chunk {idx}/{len(chunks)}")
             
@@ -690,7 +1215,7 @@ def stream_opencode_output(chat_id: str, command_args: List[str]) -> None:
         except Exception as e:
             logger.error(f"Error sending summary: {e}")
             try:
-                bot.send_chat_action(chat_id, 'typing')
+                send_typing(chat_id)
                 bot.send_message(chat_id, f"📊 Summary:\n{escape_markdown_v2(summary_text)}", parse_mode="MarkdownV2")
             except Exception as e2:
                 logger.error(f"Error sending plain summary: {e2}")
@@ -707,17 +1232,111 @@ def stream_opencode_output(chat_id: str, command_args: List[str]) -> None:
         
     except Exception as e:
         logger.error(f"Error streaming opencode output: {e}")
+        # Let already queued output go out first so the error comes last
+        outbox.put(None)
+        sender_thread.join()
         bot.send_message(
             chat_id,
             escape_markdown_v2(f"❌ Error: {str(e)}"),
             parse_mode="MarkdownV2"
         )
+    finally:
+        outbox.put(None)  # Stops the sender if streaming failed early
+
+# Streaming an opencode run can take minutes; run it off the polling thread
+command_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_COMMANDS, thread_name_prefix="opencode")
+
+def build_run_args(chat_id: int, prompt: str) -> List[str]:
+    """Build the `opencode run` arguments for a prompt from the chat's current settings."""
+    # Get current project path
+    current_project = get_current_project(chat_id)
+    
+    # Get current model
+    current_model = get_current_model(chat_id)
+    
+    # Build base command
+    base_args = ["run", prompt, "--format", "json"]
+    
+    # Add project directory
+    if current_project:
+        base_args.extend(["--dir", current_project])
+    
+    # Add model
+    if current_model:
+        base_args.extend(["--model", current_model])
+    
+    # Check if we have an active session
+    current_session_id = get_current_session_id(chat_id)
+    
+    if current_session_id:
+        # Use the existing session
+        logger.info(f"Using existing session {current_session_id}")
+        return base_args + ["--session", current_session_id]
+    
+    # Check if there are existing sessions to use instead of always creating a new one
+    logger.info("No active session found, checking for existing sessions...")
+    try:
+        # Most recently updated session, picked when the list was cached
+        selected_session_id = get_latest_session_id()
+        
+        if selected_session_id:
+            logger.info(f"Using latest existing session {selected_session_id}")
+            return base_args + ["--session", selected_session_id]
+        
+        # No existing sessions, create a new one using --continue
+        logger.info("No existing sessions, creating new session with --continue")
+    except Exception as e:
+        logger.error(f"Error checking existing sessions: {e}")
+        # If we can't check sessions, fall back to creating a new one
+        logger.info("Falling back to creating new session with --continue")
+    
+    # Just send a message to user to indicate it's running
+    escaped_message = escape_markdown_v2("Executing command... Please wait.")
+    bot.send_message(chat_id, escaped_message, parse_mode="MarkdownV2")
+    return base_args + ["--continue"]
+
+def run_chat_command(chat_id: int, prompt: str) -> None:
+    """Run a prompt through opencode, then submit the chat's next queued one."""
+    try:
+        command_args = build_run_args(chat_id, prompt)
+        # Reuse a long-lived opencode server when one is configured
+        server_url = get_opencode_server_url()
+        if server_url:
+            command_args = command_args + ["--attach", server_url]
+        stream_opencode_output(chat_id, command_args)
+    finally:
+        # The run may have created or updated a session
+        invalidate_session_cache()
+        with store_lock:
+            pending = chat_queues[chat_id]
+            if pending:
+                next_prompt = pending.popleft()
+            else:
+                del chat_queues[chat_id]
+                next_prompt = None
+        if next_prompt is not None:
+            command_executor.submit(run_chat_command, chat_id, next_prompt)
+
+def submit_opencode_command(chat_id: int, prompt: str) -> None:
+    """Queue a prompt on the worker pool and return immediately.
+    
+    Each chat has at most one command on the pool; later prompts wait in
+    chat_queues, so a busy chat never ties up workers other chats need.
+    The command line is built only when a prompt is taken off the queue.
+    """
+    with store_lock:
+        pending = chat_queues.get(chat_id)
+        if pending is not None:
+            pending.append(prompt)
+            return
+        chat_queues[chat_id] = deque()
+    command_executor.submit(run_chat_command, chat_id, prompt)
 
 @bot.message_handler(commands=['project'])
 def handle_project_command(message):
     """Handle /project command - list workspace projects, switch, or clone."""
-    chat_id = str(message.chat.id)
-    project_input = message.text[len('/project'):].strip()
+    chat_id = message.chat.id
+    project_input = message.text.partition(' ')[2].strip()
     
     # Get current project first (needed for workspace path)
     current_project = get_current_project(chat_id)
@@ -739,7 +1358,7 @@ def handle_project_command(message):
                 ['git', 'clone', project_input, clone_path],
                 capture_output=True,
                 text=True,
-                timeout=300
+                timeout=COMMAND_TIMEOUT
             )
             
             if result.returncode != 0:
@@ -833,11 +1452,11 @@ def handle_project_command(message):
 @bot.message_handler(commands=['project_list'])
 def handle_project_list_command(message):
     """Handle /project_list command - show workspace and root directories."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /project_list command from chat {chat_id}")
     
     try:
-        project_input = message.text[len('/project_list'):].strip()
+        project_input = message.text.partition(' ')[2].strip()
         
         # Get current project path
         current_project = get_current_project(chat_id)
@@ -913,7 +1532,7 @@ def handle_project_list_command(message):
 @bot.message_handler(commands=['root'])
 def handle_root_command(message):
     """Handle /root command - set to project root."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /root command from chat {chat_id}")
     
     try:
@@ -943,8 +1562,8 @@ def handle_root_command(message):
 @bot.message_handler(commands=['workspace'])
 def handle_workspace_command(message):
     """Handle /workspace command - set workspace project."""
-    chat_id = str(message.chat.id)
-    workspace_name = message.text[len('/workspace'):].strip()
+    chat_id = message.chat.id
+    workspace_name = message.text.partition(' ')[2].strip()
     logger.info(f"Received /workspace command for {workspace_name} from chat {chat_id}")
     
     try:
@@ -986,7 +1605,7 @@ def handle_workspace_command(message):
 @bot.message_handler(commands=['help'])
 def handle_help_command(message):
     """Handle /help command."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /help command from chat {chat_id}")
     
     try:
@@ -1026,15 +1645,14 @@ def handle_help_command(message):
 @bot.message_handler(commands=['session'])
 def handle_session_command(message):
     """Handle /session command."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /session command from chat {chat_id}")
     
     try:
         # Show typing indicator for long-running operations
-        bot.send_chat_action(chat_id, 'typing')
+        send_typing(chat_id)
         
-        result = run_opencode_command(["session", "list", "--format", "json"])
-        sessions_data = json.loads(result.stdout)
+        sessions_data, _ = get_cached_sessions()
         formatted_sessions = format_session_list(sessions_data)
         escaped_message = escape_markdown_v2(formatted_sessions)
         bot.reply_to(message, escaped_message, parse_mode="MarkdownV2")
@@ -1047,12 +1665,12 @@ def handle_session_command(message):
 @bot.message_handler(commands=['set_session'])
 def handle_set_session_command(message):
     """Handle /set_session command."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /set_session command from chat {chat_id}")
     
     try:
         # Extract session ID from message
-        session_id = message.text[len('/set_session'):].strip()
+        session_id = message.text.partition(' ')[2].strip()
         if not session_id:
             escaped_message = escape_markdown_v2("Please provide a session ID. Usage: /set_session <session_id>")
             bot.reply_to(message, escaped_message, parse_mode="MarkdownV2")
@@ -1066,6 +1684,7 @@ def handle_set_session_command(message):
             
         # Set session ID
         set_current_session_id(chat_id, session_id)
+        invalidate_session_cache()
         escaped_message = escape_markdown_v2(f"Current session set to: {session_id}")
         bot.reply_to(message, escaped_message, parse_mode="MarkdownV2")
         
@@ -1077,7 +1696,7 @@ def handle_set_session_command(message):
 @bot.message_handler(commands=['current_project'])
 def handle_current_project_command(message):
     """Handle /current_project command - show current project."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /current_project command from chat {chat_id}")
     
     try:
@@ -1098,7 +1717,7 @@ def handle_current_project_command(message):
 @bot.message_handler(commands=['current_session'])
 def handle_current_session_command(message):
     """Handle /current_session command."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /current_session command from chat {chat_id}")
     
     try:
@@ -1108,14 +1727,10 @@ def handle_current_session_command(message):
         if not session_id:
             session_id = None
             try:
-                result = run_opencode_command(["session", "list", "--format", "json"])
-                sessions_data = json.loads(result.stdout)
+                session_id = get_latest_session_id()
                 
-                if sessions_data and isinstance(sessions_data, list):
-                    latest_session = max(sessions_data, key=lambda x: x.get('updated', x.get('created', 0)))
-                    session_id = latest_session.get('id', '')
-                    if session_id:
-                        logger.info(f"Auto-detected latest session: {session_id}")
+                if session_id:
+                    logger.info(f"Auto-detected latest session: {session_id}")
                 else:
                     logger.warning("Session list is empty or not a list")
             except json.JSONDecodeError as e:
@@ -1142,12 +1757,12 @@ def handle_current_session_command(message):
 @bot.message_handler(commands=['new_session'])
 def handle_new_session_command(message):
     """Handle /new_session command."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /new_session command from chat {chat_id}")
     
     try:
         # Show typing indicator
-        bot.send_chat_action(chat_id, 'typing')
+        send_typing(chat_id)
         
         # Clear the current session for this chat
         session_id = get_current_session_id(chat_id)
@@ -1156,6 +1771,7 @@ def handle_new_session_command(message):
         
         # Clear session from store - next command will create a new session automatically
         set_current_session_id(chat_id, "")
+        invalidate_session_cache()
         
         escaped_message = escape_markdown_v2("✅ Session cleared.\n\n💡 Your next command will create a new session automatically.")
         bot.reply_to(message, escaped_message, parse_mode="MarkdownV2")
@@ -1169,7 +1785,7 @@ def handle_new_session_command(message):
 @bot.message_handler(commands=['compact'])
 def handle_compact_command(message):
     """Handle /compact command."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /compact command from chat {chat_id}")
     
     try:
@@ -1183,11 +1799,8 @@ def handle_compact_command(message):
             session_id = get_current_session_id(chat_id)
             
             if not session_id:
-                result = run_opencode_command(["session", "list", "--format", "json"])
-                sessions_data = json.loads(result.stdout)
-                if sessions_data:
-                    latest_session = max(sessions_data, key=lambda x: x.get('updated', x.get('created', 0)))
-                    session_id = latest_session['id']
+                session_id = get_latest_session_id()
+                if session_id:
                     set_current_session_id(chat_id, session_id)
                     logger.info(f"Auto-detected latest session: {session_id}")
                 else:
@@ -1216,7 +1829,7 @@ def handle_compact_command(message):
 @bot.message_handler(commands=['reset'])
 def handle_reset_command(message):
     """Handle /reset command."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /reset command from chat {chat_id}")
     
     try:
@@ -1233,13 +1846,13 @@ def handle_reset_command(message):
 @bot.message_handler(commands=['model'])
 def handle_model_command(message):
     """Handle /model command."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /model command from chat {chat_id}")
     
     try:
-        bot.send_chat_action(chat_id, 'typing')
+        send_typing(chat_id)
         
-        model_arg = message.text[len('/model'):].strip()
+        model_arg = message.text.partition(' ')[2].strip()
         
         if not model_arg:
             # Show current model and available models
@@ -1286,11 +1899,11 @@ def handle_model_command(message):
 @bot.message_handler(commands=['status'])
 def handle_status_command(message):
     """Handle /status command - show current configuration."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /status command from chat {chat_id}")
     
     try:
-        bot.send_chat_action(chat_id, 'typing')
+        send_typing(chat_id)
         
         current_model = get_current_model(chat_id)
         current_project = get_current_project(chat_id)
@@ -1312,11 +1925,11 @@ def handle_status_command(message):
 @bot.message_handler(commands=['stats'])
 def handle_stats_command(message):
     """Handle /stats command - show opencode usage statistics."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /stats command from chat {chat_id}")
     
     try:
-        bot.send_chat_action(chat_id, 'typing')
+        send_typing(chat_id)
         
         result = run_opencode_command(["stats"], timeout=10)
         stats_output = result.stdout
@@ -1332,14 +1945,13 @@ def handle_stats_command(message):
 @bot.message_handler(commands=['history'])
 def handle_history_command(message):
     """Handle /history command - show recent sessions."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /history command from chat {chat_id}")
     
     try:
-        bot.send_chat_action(chat_id, 'typing')
+        send_typing(chat_id)
         
-        result = run_opencode_command(["session", "list", "--format", "json"])
-        sessions = json.loads(result.stdout)
+        sessions, _ = get_cached_sessions()
         
         if not sessions:
             escaped_message = escape_markdown_v2("No session history found.")
@@ -1368,7 +1980,7 @@ def handle_history_command(message):
 @bot.message_handler(commands=['cancel'])
 def handle_cancel_command(message):
     """Handle /cancel command - cancel current running command."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /cancel command from chat {chat_id}")
     
     try:
@@ -1377,14 +1989,14 @@ def handle_cancel_command(message):
             if process.poll() is None:  # Process still running
                 try:
                     process.terminate()
-                    bot.reply_to(message, "❌ Command cancelled.", parse_mode="MarkdownV2")
+                    bot.reply_to(message, escape_markdown_v2("❌ Command cancelled."), parse_mode="MarkdownV2")
                 except ProcessLookupError:
-                    bot.reply_to(message, "❌ Command already terminated.", parse_mode="MarkdownV2")
+                    bot.reply_to(message, escape_markdown_v2("❌ Command already terminated."), parse_mode="MarkdownV2")
             else:
-                bot.reply_to(message, "❌ No command is currently running.", parse_mode="MarkdownV2")
+                bot.reply_to(message, escape_markdown_v2("❌ No command is currently running."), parse_mode="MarkdownV2")
             del active_process[chat_id]
         else:
-            bot.reply_to(message, "❌ No command is currently running.", parse_mode="MarkdownV2")
+            bot.reply_to(message, escape_markdown_v2("❌ No command is currently running."), parse_mode="MarkdownV2")
             
     except Exception as e:
         logger.error(f"Error handling /cancel command: {e}")
@@ -1392,7 +2004,7 @@ def handle_cancel_command(message):
 @bot.message_handler(commands=['restart'])
 def handle_restart_command(message):
     """Handle /restart command - restart the bot."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received /restart command from chat {chat_id}")
     
     try:
@@ -1407,7 +2019,8 @@ def handle_restart_command(message):
         bot.reply_to(message, escape_markdown_v2("🔄 Restarting bot..."), parse_mode="MarkdownV2")
         
         # Clear all sessions
-        session_store.clear()
+        with store_lock:
+            session_store.clear()
         logger.info("Cleared all sessions")
         
         try:
@@ -1436,7 +2049,6 @@ def handle_restart_command(message):
             bot.reply_to(message, escape_markdown_v2(f"⚠️ Git pull failed: {str(git_error)[:200]}"), parse_mode="MarkdownV2")
         
         # Wait a moment then restart
-        import time
         time.sleep(2)
         
         # Kill and restart the process
@@ -1451,71 +2063,11 @@ def handle_restart_command(message):
         escaped_error = escape_markdown_v2(f"Error: {str(e)}")
         bot.reply_to(message, escaped_error, parse_mode="MarkdownV2")
 
-@bot.message_handler(func=lambda message: True)
+@bot.message_handler(content_types=['text'])
 def handle_message(message):
     """Handle regular messages."""
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     logger.info(f"Received message from chat {chat_id}: {message.text}")
-    
-    # Get current project path
-    current_project = get_current_project(chat_id)
-    
-    # Get current model
-    current_model = get_current_model(chat_id)
-    
-    # Build base command
-    base_args = ["run", message.text, "--format", "json"]
-    
-    # Add project directory
-    if current_project:
-        base_args.extend(["--dir", current_project])
-    
-    # Add model
-    if current_model:
-        base_args.extend(["--model", current_model])
-    
-    # Check if we have an active session
-    current_session_id = get_current_session_id(chat_id)
-    
-    if current_session_id:
-        # Use the existing session
-        logger.info(f"Using existing session {current_session_id}")
-        command_args = base_args + ["--session", current_session_id]
-        stream_opencode_output(chat_id, command_args)
-    else:
-        # Check if there are existing sessions to use instead of always creating a new one
-        logger.info("No active session found, checking for existing sessions...")
-        try:
-            # First, get the list of existing sessions
-            result = run_opencode_command(["session", "list", "--format", "json"])
-            sessions_data = json.loads(result.stdout)
-            
-            if sessions_data:
-                # Sort sessions by updated time (most recent first)
-                latest_session = max(sessions_data, key=lambda x: x.get('updated', x.get('created', 0)))
-                selected_session_id = latest_session['id']
-                
-                logger.info(f"Using latest existing session {selected_session_id}")
-                command_args = base_args + ["--session", selected_session_id]
-                stream_opencode_output(chat_id, command_args)
-            else:
-                # No existing sessions, create a new one using --continue
-                logger.info("No existing sessions, creating new session with --continue")
-                command_args = base_args + ["--continue"]
-                
-                # Execute the command, but just send a message to user to indicate it's running
-                escaped_message = escape_markdown_v2("Executing command... Please wait.")
-                bot.send_message(chat_id, escaped_message, parse_mode="MarkdownV2")
-                
-                stream_opencode_output(chat_id, command_args)
-                
-        except Exception as e:
-            logger.error(f"Error checking existing sessions: {e}")
-            # If we can't check sessions, fall back to creating a new one
-            logger.info("Falling back to creating new session with --continue")
-            command_args = base_args + ["--continue"]
-            
-            escaped_message = escape_markdown_v2("Executing command... Please wait.")
-            bot.send_message(chat_id, escaped_message, parse_mode="MarkdownV2")
-            
-            stream_opencode_output(chat_id, command_args)
\ No newline at end of file
+    # The project, model and session are looked up when the prompt runs, so
+    # a /project, /model or /session sent meanwhile applies to it
+    submit_opencode_command(chat_id, message.text)
\ No newline at end of file
@@ -5,8 +5,10 @@ Unit tests for Telegram Controller for OpenCode
 
 import pytest
 import json
+import io
 import sys
 import os
+import time
 from unittest.mock import Mock, patch, MagicMock, mock_open
 
 # Mock telebot module to prevent Telegram bot initialization during tests
@@ -21,15 +23,27 @@ from src.telegram_controller import (
     escape_markdown_v2,
     escape_only_dots,
     process_output_line,
+    format_message,
     format_session_list,
     is_valid_session_id,
     set_current_session_id,
     get_current_session_id,
     stream_opencode_output,
+    iter_json_objects,
+    read_text_chunks,
     run_opencode_command,
     get_action_message
 )
 
+
+@pytest.fixture(autouse=True)
+def reset_session_state():
+    """Start each test with no stored or cached sessions."""
+    from src import telegram_controller
+    telegram_controller.session_store.clear()
+    telegram_controller.invalidate_session_cache()
+    yield
+
 def test_escape_markdown_v2():
     """Test markdown escaping function."""
     # Basic escaping
@@ -42,20 +56,24 @@ def test_escape_markdown_v2():
     assert "\\*" in result
     assert "\\_" in result
     assert "\\~" in result
+    
+    # Brackets are reserved too
+    assert escape_markdown_v2("[a]") == "\\[a\\]"
 
 
-def test_process_output_line_text():
+@pytest.mark.parametrize("line, expected", [
+    ('{"type": "text", "text": "Hello World"}', "Hello World"),
+    # JSON escapes go through the parser
+    ('{"type": "text", "text": "say \\"hi\\"\\n"}', 'say "hi"'),
+    ('{"type": "text", "part": {"text": "Hello from part"}}', "Hello from part"),
+    # Missing or non-string text yields nothing
+    ('{"type": "text", "text": null}', ""),
+    ('{"type": "text", "text": 5}', ""),
+    ('{"type": "text", "part": {"text": null}}', ""),
+])
+def test_process_output_line_text(line, expected):
     """Test processing text messages."""
-    line = '{"type": "text", "text": "Hello World"}'
-    result = process_output_line(line, "test_chat")
-    assert result == "Hello World"
-
-
-def test_process_output_line_text_with_part():
-    """Test processing text messages with part structure."""
-    line = '{"type": "text", "part": {"text": "Hello from part"}}'
-    result = process_output_line(line, "test_chat")
-    assert result == "Hello from part"
+    assert process_output_line(line, "test_chat") == expected
 
 
 def test_process_output_line_tool_use():
@@ -67,6 +85,13 @@ def test_process_output_line_tool_use():
     assert '"param": "value"' in result
 
 
+@pytest.mark.parametrize("state", ["null", '"running"'])
+def test_process_output_line_tool_use_bad_state(state):
+    """Test that a null or non-object tool state is tolerated."""
+    line = '{"type": "tool_use", "part": {"tool": "test_tool", "state": %s}}' % state
+    assert process_output_line(line, "test_chat") == "[test_tool]:"
+
+
 def test_process_output_line_tool_use_fallback():
     """Test processing tool_use messages with fallback structure."""
     line = '{"type": "tool_use", "tool_name": "fallback_tool", "input": {"param": "value"}}'
@@ -75,6 +100,26 @@ def test_process_output_line_tool_use_fallback():
     assert '"param": "value"' in result
 
 
+def test_format_message():
+    """Test formatting structured messages by type."""
+    assert format_message({"type": "text", "text": "Hi"}) == "Hi"
+    assert format_message({"type": "error", "message": "boom"}) == "Error: boom"
+    assert format_message({"type": "file", "path": "a.py"}) == "Created file: a.py"
+    assert format_message({"type": "completed"}) == "Operation completed successfully."
+    assert '"type": "other"' in format_message({"type": "other"})
+
+
+def test_process_output_line_plain_text():
+    """Test that non-JSON lines are returned as stripped text."""
+    assert process_output_line("Building project...  ", "test_chat") == "Building project..."
+
+
+def test_process_output_line_step_messages():
+    """Test that step messages are dropped."""
+    assert process_output_line('{"type": "step_start", "step": 1}', "test_chat") == ""
+    assert process_output_line('{"type":"step_finish","step":1}', "test_chat") == ""
+
+
 def test_format_session_list():
     """Test formatting session list."""
     sessions = [
@@ -108,6 +153,307 @@ def test_session_management():
     assert get_current_session_id("non_existent_chat") == ""
 
 
+def test_session_store_evicts_least_recent_chat():
+    """Test that the session store is bounded by MAX_TRACKED_CHATS."""
+    with patch('src.telegram_controller.MAX_TRACKED_CHATS', 2):
+        set_current_session_id("chat_a", "sess_a")
+        set_current_session_id("chat_b", "sess_b")
+        assert get_current_session_id("chat_a") == "sess_a"
+        set_current_session_id("chat_c", "sess_c")
+    
+    assert get_current_session_id("chat_b") == ""
+    assert get_current_session_id("chat_a") == "sess_a"
+    assert get_current_session_id("chat_c") == "sess_c"
+
+
+def test_is_valid_session_id_uses_cached_session_list():
+    """Test that session validation reuses a recent session list."""
+    mock_result = Mock(stdout=json.dumps([{"id": "sess_123"}, {"id": "sess_456"}]))
+    
+    with patch('src.telegram_controller.run_opencode_command', return_value=mock_result) as mock_run:
+        assert is_valid_session_id("sess_123", "test_chat")
+        assert is_valid_session_id("sess_456", "test_chat")
+        assert not is_valid_session_id("sess_789", "test_chat")
+    
+    mock_run.assert_called_once()
+
+
+def test_is_valid_session_id_rejects_malformed_id():
+    """Test that malformed IDs are rejected without listing sessions."""
+    with patch('src.telegram_controller.run_opencode_command') as mock_run:
+        assert not is_valid_session_id("sess 123; rm", "test_chat")
+        assert not is_valid_session_id("", "test_chat")
+    
+    mock_run.assert_not_called()
+
+
+def test_get_latest_session_id():
+    """Test that the most recently updated session is picked from the cached list."""
+    from src import telegram_controller
+    sessions = [{"id": "sess_old", "updated": 1}, {"id": "sess_new", "updated": 5}, {"id": "sess_mid", "created": 3}]
+    mock_result = Mock(stdout=json.dumps(sessions))
+    
+    with patch('src.telegram_controller.run_opencode_command', return_value=mock_result) as mock_run:
+        assert telegram_controller.get_latest_session_id() == "sess_new"
+        assert telegram_controller.get_latest_session_id() == "sess_new"
+    
+    mock_run.assert_called_once()
+
+
+def test_get_latest_session_id_survives_invalidation():
+    """Test that invalidating the cache mid-call doesn't lose the latest session."""
+    from src import telegram_controller
+    mock_result = Mock(stdout=json.dumps([{"id": "sess_new", "updated": 5}]))
+    
+    real_get = telegram_controller._get_session_list
+    def get_then_invalidate(ttl):
+        cached = real_get(ttl)
+        # Another worker finishes a run right after the list is cached
+        telegram_controller.invalidate_session_cache()
+        return cached
+    
+    with patch('src.telegram_controller.run_opencode_command', return_value=mock_result), \
+         patch('src.telegram_controller._get_session_list', side_effect=get_then_invalidate):
+        assert telegram_controller.get_latest_session_id() == "sess_new"
+
+
+def test_stream_opencode_output_batches_text_messages():
+    """Test that consecutive streamed text lines are sent as one message."""
+    from src import telegram_controller
+    process = Mock()
+    process.stdout = io.BytesIO(
+        b'{"type": "text", "text": "first"}\n'
+        b'{"type": "text", "text": "second"}\n'
+        b'{"type": "text", "text": "third"}\n'
+    )
+    process.stderr = []
+    process.wait.return_value = 0
+    telegram_controller.bot.reset_mock()
+    
+    with patch('src.telegram_controller.subprocess.Popen', return_value=process):
+        stream_opencode_output("test_chat", ["run", "hi"])
+    
+    first_call = telegram_controller.bot.send_message.call_args_list[0]
+    assert first_call[0][1] == "first\n\nsecond\n\nthird"
+    assert first_call[1].get("parse_mode") is None
+
+
+def test_submit_opencode_command_queues_per_chat():
+    """Test that a busy chat doesn't hold workers other chats need."""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from src import telegram_controller
+    release = threading.Event()
+    chat_b_done = threading.Event()
+    chat_a_done = threading.Event()
+    runs = []
+    running = set()
+    
+    def fake_stream(chat_id, command_args):
+        assert chat_id not in running
+        running.add(chat_id)
+        prompt = command_args[1]
+        session_id = command_args[command_args.index("--session") + 1]
+        runs.append((chat_id, prompt, session_id))
+        if chat_id == "chat_a":
+            release.wait(5)
+            if prompt == "a3":
+                chat_a_done.set()
+        else:
+            chat_b_done.set()
+        running.discard(chat_id)
+    
+    set_current_session_id("chat_a", "sess_1")
+    set_current_session_id("chat_b", "sess_b")
+    executor = ThreadPoolExecutor(max_workers=2)
+    with patch.object(telegram_controller, 'command_executor', executor), \
+         patch('src.telegram_controller.stream_opencode_output', side_effect=fake_stream), \
+         patch('src.telegram_controller.get_opencode_server_url', return_value=None):
+        for prompt in ("a1", "a2", "a3"):
+            telegram_controller.submit_opencode_command("chat_a", prompt)
+        telegram_controller.submit_opencode_command("chat_b", "b1")
+        assert chat_b_done.wait(5)
+        # Switching session while a1 runs applies to the queued prompts
+        set_current_session_id("chat_a", "sess_2")
+        release.set()
+        assert chat_a_done.wait(5)
+    executor.shutdown(wait=True)
+    
+    assert [run[1:] for run in runs if run[0] == "chat_a"] == [("a1", "sess_1"), ("a2", "sess_2"), ("a3", "sess_2")]
+    assert telegram_controller.chat_queues == {}
+
+
+def test_stream_opencode_output_tolerates_null_fields():
+    """Test that null text and state fields don't abort the run."""
+    from src import telegram_controller
+    process = Mock()
+    process.stdout = io.BytesIO(
+        b'{"type": "text", "text": null}\n'
+        b'{"type": "text", "part": {"text": 5}}\n'
+        b'{"type": "tool_use", "part": {"tool": "read", "state": null}}\n'
+        b'{"type": "tool_use", "part": {"tool": null, "state": {"status": "running"}}}\n'
+        b'{"type": "tool_use", "part": {"tool": "bash", "state": {"status": "completed", "input": null}}}\n'
+        b'{"type": "text", "text": "after"}\n'
+    )
+    process.stderr = []
+    process.wait.return_value = 0
+    telegram_controller.bot.reset_mock()
+    
+    with patch('src.telegram_controller.subprocess.Popen', return_value=process):
+        stream_opencode_output("test_chat", ["run", "hi"])
+    
+    texts = [c[0][1] for c in telegram_controller.bot.send_message.call_args_list]
+    assert texts[0] == "💻 Running\n\nafter"
+    assert not any("Error" in text for text in texts)
+
+
+def test_send_outbox_flushes_partial_batch_when_idle():
+    """Test that a batch below the size limit goes out once output pauses."""
+    import queue
+    import threading
+    from src import telegram_controller
+    telegram_controller.bot.reset_mock()
+    outbox = queue.Queue()
+    
+    with patch('src.telegram_controller.BATCH_IDLE_TIMEOUT', 0.05):
+        sender = threading.Thread(target=telegram_controller.send_outbox, args=("test_chat", outbox))
+        sender.start()
+        outbox.put(("first", None))
+        outbox.put(("second", None))
+        deadline = time.monotonic() + 5
+        while not telegram_controller.bot.send_message.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Sent before the stream ends
+        telegram_controller.bot.send_message.assert_called_once_with("test_chat", "first\n\nsecond", parse_mode=None)
+        outbox.put(None)
+        sender.join(5)
+    
+    telegram_controller.bot.send_message.assert_called_once()
+
+
+def test_stream_opencode_output_sends_error_after_queued_text():
+    """Test that an error doesn't overtake text still waiting in the batch."""
+    from src import telegram_controller
+    process = Mock()
+    # The pipe breaks while "before" is still waiting in the batch
+    process.stdout = Mock()
+    process.stdout.read1.side_effect = [b'{"type": "text", "text": "before"}\n', OSError("boom")]
+    process.stderr = []
+    telegram_controller.bot.reset_mock()
+    
+    with patch('src.telegram_controller.subprocess.Popen', return_value=process):
+        stream_opencode_output("test_chat", ["run", "hi"])
+    
+    texts = [c[0][1] for c in telegram_controller.bot.send_message.call_args_list]
+    assert texts[0] == "before"
+    assert "boom" in texts[-1]
+
+
+def test_iter_json_objects_multiline():
+    """Test that objects spanning several chunks are decoded once complete."""
+    chunks = [
+        'starting up\n',
+        '{"type": "tool_use", "part": {\n',
+        '  "tool": "bash"}}\n{"type": "text", "text": "done"}\n',
+        '{bad json}\n',
+    ]
+    objects = list(iter_json_objects(chunks))
+    assert objects == [
+        {"type": "tool_use", "part": {"tool": "bash"}},
+        {"type": "text", "text": "done"},
+    ]
+
+
+def test_iter_json_objects_split_at_every_offset():
+    """Test that a line split anywhere still yields exactly one identical event."""
+    line = ('{"type": "tool_use", "ok": true, "none": null, "n": -12.5e3, "f": 0.5, '
+            '"text": "caf\\u00e9 \\u001b[0m", "part": {"start": 1, "end": 2}}\n')
+    expected = json.loads(line)
+    for i in range(len(line) + 1):
+        assert list(iter_json_objects([line[:i], line[i:]])) == [expected], i
+    # One character per chunk, and without the trailing newline
+    assert list(iter_json_objects(line)) == [expected]
+    assert list(iter_json_objects([line[:40], line[40:-1]])) == [expected]
+
+
+def test_get_opencode_server_url_failed_start():
+    """Test that a server that never listens is terminated and retried after a backoff."""
+    from src import telegram_controller
+    server = Mock()
+    server.poll.return_value = None
+    
+    with patch.object(telegram_controller, 'OPENCODE_SERVER_URL', None), \
+         patch.object(telegram_controller, 'OPENCODE_SERVE_PORT', '4096'), \
+         patch.object(telegram_controller, '_opencode_server', None), \
+         patch.object(telegram_controller, '_opencode_server_retry_delay', 0.0), \
+         patch.object(telegram_controller, '_opencode_server_retry_at', 0.0), \
+         patch('src.telegram_controller._wait_for_port', return_value=False), \
+         patch('src.telegram_controller.subprocess.Popen', return_value=server) as mock_popen:
+        assert telegram_controller.get_opencode_server_url() is None
+        server.terminate.assert_called_once()
+        assert telegram_controller._opencode_server is None
+        # Within the backoff, runs stay standalone without another start
+        assert telegram_controller.get_opencode_server_url() is None
+        mock_popen.assert_called_once()
+
+
+def test_get_opencode_server_url_waits_without_lock():
+    """Test that other workers can take the server lock while a start is waiting."""
+    from src import telegram_controller
+    server = Mock()
+    server.poll.return_value = None
+    
+    def wait_for_port(port, timeout, process):
+        assert telegram_controller._opencode_server_lock.acquire(blocking=False)
+        telegram_controller._opencode_server_lock.release()
+        return True
+    
+    with patch.object(telegram_controller, 'OPENCODE_SERVER_URL', None), \
+         patch.object(telegram_controller, 'OPENCODE_SERVE_PORT', '4096'), \
+         patch.object(telegram_controller, '_opencode_server', None), \
+         patch.object(telegram_controller, '_opencode_server_retry_at', 0.0), \
+         patch('src.telegram_controller._wait_for_port', side_effect=wait_for_port), \
+         patch('src.telegram_controller.subprocess.Popen', return_value=server):
+        assert telegram_controller.get_opencode_server_url() == "http://127.0.0.1:4096"
+        assert telegram_controller._opencode_server is server
+        assert telegram_controller._opencode_server_starting is None
+
+
+def test_wait_for_port_stops_when_server_exits():
+    """Test that a server that exits during startup fails at once, whatever owns the port."""
+    from src import telegram_controller
+    server = Mock()
+    server.poll.return_value = 1
+    started = time.monotonic()
+    assert not telegram_controller._wait_for_port(4096, 15.0, server)
+    assert time.monotonic() - started < 1.0
+
+
+def test_process_object_for_summary_drops_tool_output():
+    """Test that collected tool_use events don't retain tool output."""
+    from src.telegram_controller import collect_output_for_summary, process_object_for_summary
+    collect_data = collect_output_for_summary()
+    obj = {"type": "tool_use", "part": {"tool": "read", "state": {"status": "completed", "input": {"filePath": "a.py"}, "output": "x" * 1000}}}
+    process_object_for_summary(collect_data, obj)
+    state = collect_data["lines"][0]["part"]["state"]
+    assert "output" not in state
+    assert state["input"] == {"filePath": "a.py"}
+
+
+def test_iter_json_objects_skip_prefixes():
+    """Test that lines with a skipped prefix are dropped."""
+    chunks = ['{"type": "step_start", "step": 1}\n{"type": "text", "text": "hi"}\n']
+    objects = list(iter_json_objects(chunks, ('{"type": "step_start"',)))
+    assert objects == [{"type": "text", "text": "hi"}]
+
+
+def test_read_text_chunks_split_utf8():
+    """Test that a character split across reads is decoded intact."""
+    data = "안녕 hello".encode("utf-8")
+    stream = io.BufferedReader(io.BytesIO(data), buffer_size=4)
+    assert "".join(read_text_chunks(stream, size=4)) == "안녕 hello"
+
+
 def test_process_output_line_unknown():
     """Test processing unknown message types."""
     line = '{"type": "unknown", "data": "test"}'
@@ -116,6 +462,12 @@ def test_process_output_line_unknown():
     assert "test" in result
 
 
+@pytest.mark.parametrize("line", ['[1, 2]', '[{"type": "text", "text": "hi"}]', ' 42'])
+def test_process_output_line_non_object_json(line):
+    """Test that JSON lines that aren't objects are dropped."""
+    assert process_output_line(line, "test_chat") == ""
+
+
 def test_process_output_line_json_error():
     """Test handling of invalid JSON."""
     line = '{"type": "text", "text": "Hello World"'  # Invalid JSON
@@ -124,5 +476,9 @@ def test_process_output_line_json_error():
 
 
 if __name__ == "__main__":
-    # Run tests when called directly
-    pytest.main([__file__, "-v"])
\ No newline at end of file
+    # Run tests when called directly, across all cores if pytest-xdist is installed
+    import importlib.util
+    args = [__file__, "-v"]
+    if importlib.util.find_spec("xdist"):
+        args += ["-n", "auto"]
+    sys.exit(pytest.main(args))
\ No newline at end of file
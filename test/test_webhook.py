@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the webhook endpoint in main.py
+"""
+
+import sys
+import os
+import threading
+import http.client
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+# Mock telebot and requests so main can be imported without them
+sys.modules.setdefault('telebot', MagicMock())
+sys.modules.setdefault('telebot.types', MagicMock())
+sys.modules.setdefault('requests', MagicMock())
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import main
+
+
+@pytest.fixture
+def webhook_server():
+    """Serve WebhookHandler on a free local port."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), main.WebhookHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def post_update(port, headers):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        conn.request("POST", "/", body='{"update_id": 1}', headers=headers)
+        return conn.getresponse().status
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("headers", [
+    {},
+    {"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+])
+def test_webhook_rejects_bad_secret(webhook_server, headers):
+    """Test that updates without the configured secret are rejected unprocessed."""
+    with patch.object(main, 'WEBHOOK_SECRET', 's3cret'), \
+         patch.object(main.bot, 'process_new_updates') as mock_process:
+        assert post_update(webhook_server, headers) == 403
+    mock_process.assert_not_called()
+
+
+def test_webhook_accepts_matching_secret(webhook_server):
+    """Test that an update carrying the secret is acknowledged and processed."""
+    processed = threading.Event()
+    with patch.object(main, 'WEBHOOK_SECRET', 's3cret'), \
+         patch.object(main.bot, 'process_new_updates', side_effect=lambda updates: processed.set()):
+        assert post_update(webhook_server, {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}) == 200
+        # The update is processed after the response is sent
+        assert processed.wait(5)
+
+
+def test_webhook_mode_requires_secret():
+    """Test that webhook mode refuses to start without a secret."""
+    with patch.object(main, 'WEBHOOK_URL', 'https://example.com/hook'), \
+         patch.object(main, 'WEBHOOK_SECRET', None), \
+         patch.object(main, 'send_startup_message'), \
+         patch.object(main, 'run_webhook') as mock_run, \
+         patch('signal.signal'):
+        with pytest.raises(SystemExit):
+            main.main()
+    mock_run.assert_not_called()
@@ -17,21 +17,25 @@ def test_escape_markdown_v2_dot():
 
 
 def test_escape_markdown_v2_special_chars():
-    chars = '_*$()~`>#+-=|{}'
+    chars = '_*[]()~`>#+-=|{}!'
     for c in chars:
         escaped = escape_markdown_v2(c)
         expected = '\\' + c
         assert escaped == expected, f'Char {c} not properly escaped'
 
 
+def test_escape_markdown_v2_brackets():
+    assert escape_markdown_v2('[link](url)') == '\\[link\\]\\(url\\)'
+
+
 def test_escape_markdown_v2_text():
     assert escape_markdown_v2('Hello World') == 'Hello World'
     assert escape_markdown_v2('') == ''
 
 
 def test_escape_only_dots_ellipsis():
-    assert escape_only_dots('truncated...') == 'truncated...'
-    assert escape_only_dots('see more...') == 'see more...'
+    assert escape_only_dots('truncated...') == 'truncated\.\.\.'
+    assert escape_only_dots('see more...') == 'see more\.\.\.'
 
 
 def test_escape_only_dots_single_dot():
@@ -41,8 +45,7 @@ def test_escape_only_dots_single_dot():
 
 def test_escape_only_dots_file_with_ellipsis():
     result = escape_only_dots('file.txt and more...')
-    assert '\.' in result
-    assert '...' in result
+    assert result == 'file\.txt and more\.\.\.'
 
 
 def test_escape_only_dots_version_no_ellipsis():
@@ -53,15 +56,31 @@ def test_escape_only_dots_version_no_ellipsis():
 
 def test_escape_only_dots_four_dots():
     result = escape_only_dots('test....')
-    assert '...' in result
-    assert '\.' in result
+    assert result == 'test\.\.\.\.'
 
 
 def test_escape_only_dots_special_chars_and_ellipsis():
     text = 'Check *_file*(path)...'
     result = escape_only_dots(text)
-    assert '...' in result
+    assert '\.\.\.' in result
     assert '\_' in result
     assert '\*' in result
     assert '\(' in result
     assert '\)' in result
+
+
+def _has_unescaped_reserved_char(text):
+    i = 0
+    while i < len(text):
+        if text[i] == '\\':
+            i += 2
+            continue
+        if text[i] in '_*[]()~`>#+-=|{}.!':
+            return True
+        i += 1
+    return False
+
+
+def test_escape_only_dots_output_is_valid_markdown_v2():
+    for text in ['truncated...', 'test....', 'a...b.c', 'Check *_file*(path)...', '\\...', '1.0.0!']:
+        assert not _has_unescaped_reserved_char(escape_only_dots(text)), text